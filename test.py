@@ -9,7 +9,7 @@ import numpy as np
 import yaml
 from tqdm import tqdm
 from models.experimental import attempt_load
-from utils.datasets import create_dataloader
+from utils.datasets import create_dataloader, normalize_batch
 from utils.general import (
     coco80_to_coco91_class,
     check_file,
@@ -106,8 +106,7 @@ def test(
     jdict, stats, ap, ap_class = [], [], [], []
     for batch_i, (img, targets, paths, shapes) in enumerate(tqdm(dataloader, desc=s)):
         img = img.to(device, non_blocking=True)
-        img = img.astype(dtype="float16") if half else img.astype(dtype="float32")
-        img /= 255.0
+        img = normalize_batch(img, "float16" if half else "float32")
         targets = targets.to(device)
         nb, _, height, width = img.shape
         whwh = paddle.to_tensor(
@@ -10,7 +10,7 @@ import yaml
 from tqdm import tqdm
 import test
 from models.yolo import Model
-from utils.datasets import create_dataloader
+from utils.datasets import create_dataloader, normalize_batch
 from utils.general import (
     check_img_size,
     torch_distributed_zero_first,
@@ -162,7 +162,7 @@ def train(hyp, opt, device, tb_writer=None):
         local_rank=rank,
         world_size=opt.world_size,
     )
-    mlc = np.concatenate(dataset.labels, 0)[:, 0].max()
+    mlc = dataset.labels_flat[:, 0].max()
     nb = len(dataloader)
     assert mlc < nc, (
         "Label class %g exceeds nc=%g in %s. Possible class labels are 0-%g"
@@ -187,10 +187,12 @@ def train(hyp, opt, device, tb_writer=None):
     model.nc = nc
     model.hyp = hyp
     model.gr = 1.0
-    model.class_weights = labels_to_class_weights(dataset.labels, nc).to(device)
+    model.class_weights = labels_to_class_weights(
+        np.split(dataset.labels_flat, dataset.label_offsets[1:-1]), nc
+    ).to(device)
     model.names = names
     if rank in [-1, 0]:
-        labels = np.concatenate(dataset.labels, 0)
+        labels = dataset.labels_flat
         c = paddle.to_tensor(data=labels[:, 0])
         plot_labels(labels, save_dir=log_dir)
         if tb_writer:
@@ -215,7 +217,9 @@ def train(hyp, opt, device, tb_writer=None):
             if rank in [-1, 0]:
                 w = model.class_weights.cpu().numpy() * (1 - maps) ** 2
                 image_weights = labels_to_image_weights(
-                    dataset.labels, nc=nc, class_weights=w
+                    np.split(dataset.labels_flat, dataset.label_offsets[1:-1]),
+                    nc=nc,
+                    class_weights=w,
                 )
                 dataset.indices = random.choices(
                     range(dataset.n), weights=image_weights, k=dataset.n
@@ -249,7 +253,7 @@ def train(hyp, opt, device, tb_writer=None):
         optimizer.clear_grad()
         for i, (imgs, targets, paths, _) in pbar:
             ni = i + nb * epoch
-            imgs = imgs.to(device, non_blocking=True).astype(dtype="float32") / 255.0
+            imgs = normalize_batch(imgs.to(device, non_blocking=True))
             if ni <= nw:
                 xi = [0, nw]
                 accumulate = max(
@@ -435,7 +439,11 @@ if __name__ == "__main__":
     parser.add_argument("--evolve", action="store_true", help="evolve hyperparameters")
     parser.add_argument("--bucket", type=str, default="", help="gsutil bucket")
     parser.add_argument(
-        "--cache-images", action="store_true", help="cache images for faster training"
+        "--cache-images",
+        nargs="?",
+        const=True,
+        default=False,
+        help="cache images for faster training, to a memory-mapped .npy if 'mmap'",
     )
     parser.add_argument(
         "--name", default="", help="renames results.txt to results_name.txt if supplied"
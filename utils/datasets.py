@@ -1,10 +1,15 @@
 import paddle
 import glob
+import hashlib
 import math
+import mmap
 import os
 import random
 import shutil
 import time
+import atexit
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
 from pathlib import Path
 from threading import Thread
 import cv2
@@ -13,8 +18,14 @@ from PIL import Image, ExifTags
 from tqdm import tqdm
 from utils.general import xyxy2xywh, xywh2xyxy, torch_distributed_zero_first
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
 help_url = ""
 img_formats = [".bmp", ".jpg", ".jpeg", ".png", ".tif", ".tiff", ".dng"]
+img_ext = frozenset(x[1:] for x in img_formats)
 vid_formats = [".mov", ".avi", ".mp4", ".mpg", ".mpeg", ".m4v", ".wmv", ".mkv"]
 for orientation in ExifTags.TAGS.keys():
     if ExifTags.TAGS[orientation] == "Orientation":
@@ -22,7 +33,30 @@ for orientation in ExifTags.TAGS.keys():
 
 
 def get_hash(files):
-    return sum(os.path.getsize(f) for f in files if os.path.isfile(f))
+    files = [os.path.split(f) for f in files]
+    dirs = {}
+    for d, name in files:
+        dirs.setdefault(d, set()).add(name)
+    sizes = {}
+    for d, names in dirs.items():
+        try:
+            with os.scandir(d or ".") as it:
+                for e in it:
+                    if e.name in names and e.is_file():
+                        sizes[d, e.name] = e.stat().st_size
+        except OSError:
+            pass
+    return sum(sizes.get(f, 0) for f in files)
+
+
+def img2label_paths(img_paths):
+    sa, sb = os.sep + "images" + os.sep, os.sep + "labels" + os.sep
+    paths = []
+    for x in img_paths:
+        head, sep, tail = x.rpartition(sa)
+        x = head + sb + tail if sep else x.replace("images", "labels")
+        paths.append(x.rsplit(".", 1)[0] + ".txt")
+    return paths
 
 
 def exif_size(img):
@@ -38,6 +72,60 @@ def exif_size(img):
     return s
 
 
+def fast_exif_size(path):
+    """(w, h) from JPEG/PNG headers like exif_size(Image.open(path)), None if unsure."""
+    try:
+        with open(path, "rb") as f, mmap.mmap(
+            f.fileno(), 0, access=mmap.ACCESS_READ
+        ) as m:
+            if m[:8] == b"\x89PNG\r\n\x1a\n":
+                w, h = int.from_bytes(m[16:20], "big"), int.from_bytes(m[20:24], "big")
+                i = 8
+                while m[i + 4 : i + 8] not in (b"IDAT", b"IEND", b""):
+                    if m[i + 4 : i + 8] == b"eXIf":
+                        return None
+                    i += 12 + int.from_bytes(m[i : i + 4], "big")
+                return w, h
+            if m[:2] != b"\xff\xd8":
+                return None
+            i, rotation, s = 2, None, None
+            while s is None:
+                if m[i] != 0xFF:
+                    return None
+                marker = m[i + 1]
+                if marker == 0xFF:
+                    i += 1
+                    continue
+                if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+                    i += 2
+                    continue
+                if marker in (0xD9, 0xDA):
+                    return None
+                if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                    s = (
+                        int.from_bytes(m[i + 7 : i + 9], "big"),
+                        int.from_bytes(m[i + 5 : i + 7], "big"),
+                    )
+                elif (
+                    marker == 0xE1
+                    and rotation is None
+                    and m[i + 4 : i + 10] == b"Exif\x00\x00"
+                ):
+                    t = i + 10
+                    bo = {b"II": "little", b"MM": "big"}[m[t : t + 2]]
+                    ifd = t + int.from_bytes(m[t + 4 : t + 8], bo)
+                    rotation = 0
+                    for e in range(
+                        ifd + 2, ifd + 2 + 12 * int.from_bytes(m[ifd : ifd + 2], bo), 12
+                    ):
+                        if int.from_bytes(m[e : e + 2], bo) == 0x0112:
+                            rotation = int.from_bytes(m[e + 8 : e + 10], bo)
+                i += 2 + int.from_bytes(m[i + 2 : i + 4], "big")
+            return (s[1], s[0]) if rotation in (6, 8) else s
+    except Exception:
+        return None
+
+
 def create_dataloader(
     path,
     imgsz,
@@ -67,6 +155,7 @@ def create_dataloader(
         )
     batch_size = min(batch_size, len(dataset))
     nw = min([os.cpu_count() // world_size, batch_size if batch_size > 1 else 0, 8])
+    dataset.load_threads = min(os.cpu_count() // world_size // max(nw, 1), 4)
     train_sampler = (
         paddle.io.DistributedBatchSampler(dataset=dataset, shuffle=True, batch_size=1)
         if local_rank != -1
@@ -143,8 +232,8 @@ videos: %s""" % (p, img_formats, vid_formats)
             assert img0 is not None, "Image Not Found " + path
             print("image %g/%g %s: " % (self.count, self.nf, path), end="")
         img = letterbox(img0, new_shape=self.img_size)[0]
-        img = img[:, :, ::-1].transpose(2, 0, 1)
-        img = np.ascontiguousarray(img)
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        img = np.ascontiguousarray(img.transpose(2, 0, 1))
         return path, img, img0, self.cap
 
     def new_video(self, path):
@@ -191,8 +280,8 @@ class LoadWebcam:
         img_path = "webcam.jpg"
         print("webcam %g: " % self.count, end="")
         img = letterbox(img0, new_shape=self.img_size)[0]
-        img = img[:, :, ::-1].transpose(2, 0, 1)
-        img = np.ascontiguousarray(img)
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        img = np.ascontiguousarray(img.transpose(2, 0, 1))
         return img_path, img, img0, None
 
     def __len__(self):
@@ -252,10 +341,15 @@ class LoadStreams:
         if cv2.waitKey(1) == ord("q"):
             cv2.destroyAllWindows()
             raise StopIteration
-        img = [letterbox(x, new_shape=self.img_size, auto=self.rect)[0] for x in img0]
+        img = [
+            cv2.cvtColor(
+                letterbox(x, new_shape=self.img_size, auto=self.rect)[0],
+                cv2.COLOR_BGR2RGB,
+            )
+            for x in img0
+        ]
         img = np.stack(img, 0)
-        img = img[:, :, :, ::-1].transpose(0, 3, 1, 2)
-        img = np.ascontiguousarray(img)
+        img = np.ascontiguousarray(img.transpose(0, 3, 1, 2))
         return self.sources, img, img0, None
 
     def __len__(self):
@@ -290,14 +384,19 @@ class LoadImagesAndLabels(paddle.io.Dataset):
                             for x in t
                         ]
                 elif os.path.isdir(p):
-                    f += glob.iglob(p + os.sep + "*.*")
+                    with os.scandir(p) as it:
+                        f += [
+                            e.path
+                            for e in it
+                            if e.is_file() and not e.name.startswith(".")
+                        ]
                 else:
                     raise Exception("%s does not exist" % p)
             self.img_files = sorted(
                 [
                     x.replace("/", os.sep)
                     for x in f
-                    if os.path.splitext(x)[-1].lower() in img_formats
+                    if x.rpartition(".")[2].lower() in img_ext
                 ]
             )
         except Exception as e:
@@ -318,10 +417,8 @@ class LoadImagesAndLabels(paddle.io.Dataset):
         self.mosaic = self.augment and not self.rect
         self.mosaic_border = [-img_size // 2, -img_size // 2]
         self.stride = stride
-        self.label_files = [
-            x.replace("images", "labels").replace(os.path.splitext(x)[-1], ".txt")
-            for x in self.img_files
-        ]
+        self.load_threads = 0
+        self.label_files = img2label_paths(self.img_files)
         cache_path = str(Path(self.label_files[0]).parent) + ".cache"
         if os.path.isfile(cache_path):
             cache = paddle.load(path=cache_path)
@@ -331,33 +428,30 @@ class LoadImagesAndLabels(paddle.io.Dataset):
             cache = self.cache_labels(cache_path)
         labels, shapes = zip(*[cache[x] for x in self.img_files])
         self.shapes = np.array(shapes, dtype=np.float64)
-        self.labels = list(labels)
+        labels = list(labels)
         if self.rect:
             s = self.shapes
             ar = s[:, 1] / s[:, 0]
             irect = ar.argsort()
             self.img_files = [self.img_files[i] for i in irect]
             self.label_files = [self.label_files[i] for i in irect]
-            self.labels = [self.labels[i] for i in irect]
+            labels = [labels[i] for i in irect]
             self.shapes = s[irect]
             ar = ar[irect]
-            shapes = [[1, 1]] * nb
-            for i in range(nb):
-                ari = ar[bi == i]
-                mini, maxi = ari.min(), ari.max()
-                if maxi < 1:
-                    shapes[i] = [maxi, 1]
-                elif mini > 1:
-                    shapes[i] = [1, 1 / mini]
+            starts = np.arange(0, n, batch_size)
+            mini = np.minimum.reduceat(ar, starts)
+            maxi = np.maximum.reduceat(ar, starts)
+            shapes = np.ones((nb, 2))
+            shapes[maxi < 1, 0] = maxi[maxi < 1]
+            shapes[mini > 1, 1] = 1 / mini[mini > 1]
             self.batch_shapes = (
-                np.ceil(np.array(shapes) * img_size / stride + pad).astype(np.int)
-                * stride
+                np.ceil(shapes * img_size / stride + pad).astype(np.int) * stride
             )
         create_datasubset, extract_bounding_boxes, labels_loaded = (False, False, False)
         nm, nf, ne, ns, nd = 0, 0, 0, 0, 0
         pbar = tqdm(self.label_files)
         for i, file in enumerate(pbar):
-            l = self.labels[i]
+            l = labels[i]
             if l.shape[0]:
                 assert l.shape[1] == 5, "> 5 label columns: %s" % file
                 assert (l >= 0).astype("bool").all(), "negative labels: %s" % file
@@ -368,7 +462,7 @@ class LoadImagesAndLabels(paddle.io.Dataset):
                     nd += 1
                 if single_cls:
                     l[:, 0] = 0
-                self.labels[i] = l
+                labels[i] = l
                 nf += 1
                 if create_datasubset and ns < 10000.0:
                     if ns == 0:
@@ -409,6 +503,8 @@ class LoadImagesAndLabels(paddle.io.Dataset):
                 "Scanning labels %s (%g found, %g missing, %g empty, %g duplicate, for %g images)"
                 % (cache_path, nf, nm, ne, nd, n)
             )
+        self.label_offsets = np.cumsum([0] + [len(l) for l in labels]).astype(np.int64)
+        self.labels_flat = np.concatenate(labels, 0).astype(np.float32)
         if nf == 0:
             s = "WARNING: No labels found in %s. See %s" % (
                 os.path.dirname(file) + os.sep,
@@ -417,7 +513,10 @@ class LoadImagesAndLabels(paddle.io.Dataset):
             print(s)
             assert not augment, "%s. Can not train without labels." % s
         self.imgs = [None] * n
-        if cache_images:
+        self.imgs_flat = None
+        if cache_images == "mmap":
+            self.cache_images_mmap(cache_path)
+        elif cache_images:
             gb = 0
             pbar = tqdm(range(len(self.img_files)), desc="Caching images")
             self.img_hw0, self.img_hw = [None] * n, [None] * n
@@ -425,36 +524,82 @@ class LoadImagesAndLabels(paddle.io.Dataset):
                 self.imgs[i], self.img_hw0[i], self.img_hw[i] = load_image(self, i)
                 gb += self.imgs[i].nbytes
                 pbar.desc = "Caching images (%.1fGB)" % (gb / 1000000000.0)
+            self.cache_images_shm()
 
     def cache_labels(self, path="labels.cache"):
         x = {}
-        pbar = tqdm(
-            zip(self.img_files, self.label_files),
-            desc="Scanning images",
-            total=len(self.img_files),
-        )
-        for img, label in pbar:
-            try:
-                l = []
-                image = Image.open(img)
-                image.verify()
-                shape = exif_size(image)
-                assert (shape[0] > 9) & (shape[1] > 9), "image size <10 pixels"
-                if os.path.isfile(label):
-                    with open(label, "r") as f:
-                        l = np.array(
-                            [x.split() for x in f.read().splitlines()], dtype=np.float32
-                        )
-                if len(l) == 0:
-                    l = np.zeros((0, 5), dtype=np.float32)
-                x[img] = [l, shape]
-            except Exception as e:
-                x[img] = None
-                print("WARNING: %s: %s" % (img, e))
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+            pbar = tqdm(
+                pool.map(scan_image_label, self.img_files, self.label_files),
+                desc="Scanning images",
+                total=len(self.img_files),
+            )
+            for img, l, e in pbar:
+                x[img] = l
+                if e is not None:
+                    print("WARNING: %s: %s" % (img, e))
         x["hash"] = get_hash(self.label_files + self.img_files)
         paddle.save(obj=x, path=path)
         return x
 
+    def cache_images_mmap(self, path="labels.cache"):
+        n, s = len(self.img_files), self.img_size
+        key = hashlib.md5(
+            ("%s %s\n" % (s, self.augment) + "\n".join(self.img_files)).encode()
+        ).hexdigest()[:16]
+        prefix = "%s.%s" % (os.path.splitext(path)[0], key)
+        img_path, shape_path = prefix + ".images.npy", prefix + ".shapes.npy"
+        valid = (
+            os.path.isfile(img_path)
+            and os.path.isfile(shape_path)
+            and os.path.getmtime(img_path) >= os.path.getmtime(path)
+        )
+        if valid:
+            shapes = np.load(shape_path)
+            valid = shapes.shape == (n, 4) and np.load(
+                img_path, mmap_mode="r"
+            ).shape == (n, s, s, 3)
+        if not valid:
+            tmp_path = prefix + ".images.tmp.npy"
+            imgs = np.lib.format.open_memmap(
+                tmp_path, mode="w+", dtype=np.uint8, shape=(n, s, s, 3)
+            )
+            shapes = np.zeros((n, 4), dtype=np.int64)
+            gb = 0
+            pbar = tqdm(range(n), desc="Caching images")
+            for i in pbar:
+                img, shapes[i, :2], shapes[i, 2:] = load_image(self, i)
+                imgs[i, : img.shape[0], : img.shape[1]] = img
+                gb += img.nbytes
+                pbar.desc = "Caching images (%.1fGB)" % (gb / 1000000000.0)
+            imgs.flush()
+            del imgs
+            np.save(shape_path, shapes)
+            os.replace(tmp_path, img_path)
+        self.imgs = np.load(img_path, mmap_mode="r")
+        self.img_hw0 = [(int(h), int(w)) for h, w in shapes[:, :2]]
+        self.img_hw = [(int(h), int(w)) for h, w in shapes[:, 2:]]
+
+    def cache_images_shm(self):
+        sizes = [img.nbytes for img in self.imgs]
+        if (
+            os.path.isdir("/dev/shm")
+            and sum(sizes) > shutil.disk_usage("/dev/shm").free
+        ):
+            print(
+                "WARNING: /dev/shm too small for %.1fGB image cache, "
+                "workers will not share it" % (sum(sizes) / 1000000000.0)
+            )
+            return
+        self._shm = SharedMemory(create=True, size=max(sum(sizes), 1))
+        pid = os.getpid()
+        atexit.register(lambda: os.getpid() == pid and self._shm.unlink())
+        self.img_offsets = np.cumsum([0] + sizes).astype(np.int64)
+        self.imgs_flat = np.ndarray((sum(sizes),), dtype=np.uint8, buffer=self._shm.buf)
+        for i, (a, b) in enumerate(zip(self.img_offsets[:-1], self.img_offsets[1:])):
+            self.imgs_flat[a:b] = self.imgs[i].ravel()
+            self.imgs[i] = None
+
     def __len__(self):
         return len(self.img_files)
 
@@ -466,9 +611,7 @@ class LoadImagesAndLabels(paddle.io.Dataset):
             img, labels = load_mosaic(self, index)
             shapes = None
             if random.random() < hyp["mixup"]:
-                img2, labels2 = load_mosaic(
-                    self, random.randint(0, len(self.labels) - 1)
-                )
+                img2, labels2 = load_mosaic(self, random.randint(0, self.n - 1))
                 r = np.random.beta(8.0, 8.0)
                 img = (img * r + img2 * (1 - r)).astype(np.uint8)
                 labels = np.concatenate((labels, labels2), 0)
@@ -478,7 +621,9 @@ class LoadImagesAndLabels(paddle.io.Dataset):
             img, ratio, pad = letterbox(img, shape, auto=False, scaleup=self.augment)
             shapes = (h0, w0), ((h / h0, w / w0), pad)
             labels = []
-            x = self.labels[index]
+            x = self.labels_flat[
+                self.label_offsets[index] : self.label_offsets[index + 1]
+            ]
             if x.size > 0:
                 labels = x.copy()
                 labels[:, 1] = ratio[0] * w * (x[:, 1] - x[:, 3] / 2) + pad[0]
@@ -504,33 +649,76 @@ class LoadImagesAndLabels(paddle.io.Dataset):
             labels[:, [1, 3]] /= img.shape[1]
         if self.augment:
             if random.random() < hyp["flipud"]:
-                img = np.flipud(img)
+                cv2.flip(img, 0, dst=img)
                 if nL:
                     labels[:, 2] = 1 - labels[:, 2]
             if random.random() < hyp["fliplr"]:
-                img = np.fliplr(img)
+                cv2.flip(img, 1, dst=img)
                 if nL:
                     labels[:, 1] = 1 - labels[:, 1]
-        labels_out = paddle.zeros(shape=(nL, 6))
+        labels_out = np.zeros((nL, 6), dtype=np.float32)
         if nL:
-            labels_out[:, 1:] = paddle.to_tensor(data=labels)
-        img = img[:, :, ::-1].transpose(2, 0, 1)
-        img = np.ascontiguousarray(img)
-        return paddle.to_tensor(data=img), labels_out, self.img_files[index], shapes
+            labels_out[:, 1:] = labels
+        return img, labels_out, self.img_files[index], shapes
 
     @staticmethod
     def collate_fn(batch):
         img, label, path, shapes = zip(*batch)
-        for i, l in enumerate(label):
-            l[:, 0] = i
-        return paddle.stack(x=img, axis=0), paddle.concat(x=label, axis=0), path, shapes
+        sizes = [len(l) for l in label]
+        label = np.concatenate(label, 0)
+        label[:, 0] = np.repeat(np.arange(len(sizes)), sizes)
+        img = paddle.to_tensor(data=np.stack(img, 0), dtype="uint8")
+        return img, paddle.to_tensor(data=label), path, shapes
+
+
+def normalize_batch(imgs, dtype="float32"):
+    """uint8 BGR NHWC batch from LoadImagesAndLabels -> RGB NCHW in [0, 1]."""
+    return paddle.flip(imgs.astype(dtype).transpose([0, 3, 1, 2]), axis=[1]) / 255.0
+
+
+def scan_image_label(img, label):
+    try:
+        l = []
+        shape = fast_exif_size(img)
+        if shape is None:
+            image = Image.open(img)
+            image.verify()
+            shape = exif_size(image)
+        assert (shape[0] > 9) & (shape[1] > 9), "image size <10 pixels"
+        if os.path.isfile(label):
+            with open(label, "r") as f:
+                l = np.array(
+                    [x.split() for x in f.read().splitlines()], dtype=np.float32
+                )
+        if len(l) == 0:
+            l = np.zeros((0, 5), dtype=np.float32)
+        return img, [l, shape], None
+    except Exception as e:
+        return img, None, e
+
+
+def imread(path):
+    try:
+        with open(path, "rb") as f, mmap.mmap(
+            f.fileno(), 0, access=mmap.ACCESS_READ
+        ) as m:
+            buf = np.frombuffer(m, dtype=np.uint8)
+            img = cv2.imdecode(buf, cv2.IMREAD_COLOR)
+            del buf
+        return img
+    except (OSError, ValueError):
+        return None
 
 
 def load_image(self, index):
+    if self.imgs_flat is not None:
+        h, w = self.img_hw[index]
+        img = self.imgs_flat[self.img_offsets[index] : self.img_offsets[index + 1]]
+        return img.reshape(h, w, 3), self.img_hw0[index], (h, w)
     img = self.imgs[index]
     if img is None:
         path = self.img_files[index]
-        img = cv2.imread(path)
+        img = imread(path)
         assert img is not None, "Image Not Found " + path
         h0, w0 = img.shape[:2]
         r = self.img_size / max(h0, w0)
@@ -539,32 +727,61 @@ def load_image(self, index):
             img = cv2.resize(img, (int(w0 * r), int(h0 * r)), interpolation=interp)
         return img, (h0, w0), img.shape[:2]
     else:
-        return self.imgs[index], self.img_hw0[index], self.img_hw[index]
+        h, w = self.img_hw[index]
+        return img[:h, :w], self.img_hw0[index], (h, w)
+
+
+def load_images(self, indices):
+    if (
+        self.load_threads < 2
+        or self.imgs_flat is not None
+        or not isinstance(self.imgs, list)
+        or all(self.imgs[i] is not None for i in indices)
+    ):
+        return [load_image(self, i) for i in indices]
+    if getattr(self, "_pool_pid", None) != os.getpid():
+        self._pool = ThreadPoolExecutor(max_workers=self.load_threads)
+        self._pool_pid = os.getpid()
+    return list(self._pool.map(lambda i: load_image(self, i), indices))
 
 
 def augment_hsv(img, hgain=0.5, sgain=0.5, vgain=0.5):
     r = np.random.uniform(-1, 1, 3) * [hgain, sgain, vgain] + 1
-    hue, sat, val = cv2.split(cv2.cvtColor(img, cv2.COLOR_BGR2HSV))
     dtype = img.dtype
     x = np.arange(0, 256, dtype=np.int16)
     lut_hue = (x * r[0] % 180).astype(dtype)
     lut_sat = np.clip(x * r[1], 0, 255).astype(dtype)
     lut_val = np.clip(x * r[2], 0, 255).astype(dtype)
-    img_hsv = cv2.merge(
-        (cv2.LUT(hue, lut_hue), cv2.LUT(sat, lut_sat), cv2.LUT(val, lut_val))
-    ).astype(dtype)
-    cv2.cvtColor(img_hsv, cv2.COLOR_HSV2BGR, dst=img)
+    lut = np.stack((lut_hue, lut_sat, lut_val), 1).reshape(256, 1, 3)
+    cv2.cvtColor(img, cv2.COLOR_BGR2HSV, dst=img)
+    cv2.LUT(img, lut, dst=img)
+    cv2.cvtColor(img, cv2.COLOR_HSV2BGR, dst=img)
 
 
 def load_mosaic(self, index):
     labels4 = []
     s = self.img_size
     yc, xc = s, s
-    indices = [index] + [random.randint(0, len(self.labels) - 1) for _ in range(3)]
-    for i, index in enumerate(indices):
-        img, _, (h, w) = load_image(self, index)
+    indices = [index] + [random.randint(0, self.n - 1) for _ in range(3)]
+    M, scale = random_perspective_matrix(
+        (s * 2, s * 2),
+        degrees=self.hyp["degrees"],
+        translate=self.hyp["translate"],
+        scale=self.hyp["scale"],
+        shear=self.hyp["shear"],
+        perspective=self.hyp["perspective"],
+        border=self.mosaic_border,
+    )
+    height = s * 2 + self.mosaic_border[0] * 2
+    width = s * 2 + self.mosaic_border[1] * 2
+    x0, y0, x1, y1 = warp_source_roi(M, (width, height), (s * 2, s * 2))
+    canvas = np.empty((s * 2, s * 2, 3), dtype=np.uint8)
+    img4 = canvas[y0:y1, x0:x1]
+    img4[:] = 114
+    for i, (index, (img, _, (h, w))) in enumerate(
+        zip(indices, load_images(self, indices))
+    ):
         if i == 0:
-            img4 = np.full((s * 2, s * 2, img.shape[2]), 114, dtype=np.uint8)
             x1a, y1a, x2a, y2a = max(xc - w, 0), max(yc - h, 0), xc, yc
             x1b, y1b, x2b, y2b = w - (x2a - x1a), h - (y2a - y1a), w, h
         elif i == 1:
@@ -576,10 +793,14 @@ def load_mosaic(self, index):
         elif i == 3:
             x1a, y1a, x2a, y2a = xc, yc, min(xc + w, s * 2), min(s * 2, yc + h)
             x1b, y1b, x2b, y2b = 0, 0, min(w, x2a - x1a), min(y2a - y1a, h)
-        img4[y1a:y2a, x1a:x2a] = img[y1b:y2b, x1b:x2b]
+        cx1, cy1, cx2, cy2 = max(x1a, x0), max(y1a, y0), min(x2a, x1), min(y2a, y1)
+        if cx1 < cx2 and cy1 < cy2:
+            img4[cy1 - y0 : cy2 - y0, cx1 - x0 : cx2 - x0] = img[
+                y1b + cy1 - y1a : y1b + cy2 - y1a, x1b + cx1 - x1a : x1b + cx2 - x1a
+            ]
         padw = x1a - x1b
         padh = y1a - y1b
-        x = self.labels[index]
+        x = self.labels_flat[self.label_offsets[index] : self.label_offsets[index + 1]]
         labels = x.copy()
         if x.size > 0:
             labels[:, 1] = w * (x[:, 1] - x[:, 3] / 2) + padw
@@ -590,16 +811,8 @@ def load_mosaic(self, index):
     if len(labels4):
         labels4 = np.concatenate(labels4, 0)
         np.clip(labels4[:, 1:], 0, 2 * s, out=labels4[:, 1:])
-    img4, labels4 = random_perspective(
-        img4,
-        labels4,
-        degrees=self.hyp["degrees"],
-        translate=self.hyp["translate"],
-        scale=self.hyp["scale"],
-        shear=self.hyp["shear"],
-        perspective=self.hyp["perspective"],
-        border=self.mosaic_border,
-    )
+    img4 = warp_image(canvas, M, (width, height))
+    labels4 = warp_targets(labels4, M, scale, (width, height))
     return img4, labels4
 
 
@@ -643,14 +856,25 @@ def letterbox(
         ratio = new_shape[1] / shape[1], new_shape[0] / shape[0]
     dw /= 2
     dh /= 2
-    if shape[::-1] != new_unpad:
-        img = cv2.resize(img, new_unpad, interpolation=cv2.INTER_LINEAR)
     top, bottom = int(round(dh - 0.1)), int(round(dh + 0.1))
     left, right = int(round(dw - 0.1)), int(round(dw + 0.1))
-    img = cv2.copyMakeBorder(
-        img, top, bottom, left, right, cv2.BORDER_CONSTANT, value=color
-    )
-    return img, ratio, (dw, dh)
+    h, w = new_unpad[1], new_unpad[0]
+    out = np.empty((h + top + bottom, w + left + right) + img.shape[2:], img.dtype)
+    if shape[::-1] != new_unpad:
+        cv2.resize(
+            img,
+            new_unpad,
+            dst=out[top : top + h, left : left + w],
+            interpolation=cv2.INTER_LINEAR,
+        )
+    else:
+        out[top : top + h, left : left + w] = img
+    fill = color[0] if len(set(color)) == 1 else color
+    out[:top] = fill
+    out[top + h :] = fill
+    out[top : top + h, :left] = fill
+    out[top : top + h, left + w :] = fill
+    return out, ratio, (dw, dh)
 
 
 def random_perspective(
@@ -665,12 +889,33 @@ def random_perspective(
 ):
     height = img.shape[0] + border[0] * 2
     width = img.shape[1] + border[1] * 2
+    M, s = random_perspective_matrix(
+        img.shape[:2], degrees, translate, scale, shear, perspective, border
+    )
+    if border[0] != 0 or border[1] != 0 or (M != np.eye(3)[: len(M)]).any():
+        img = warp_image(img, M, (width, height))
+    targets = warp_targets(targets, M, s, (width, height))
+    return img, targets
+
+
+def random_perspective_matrix(
+    shape,
+    degrees=10,
+    translate=0.1,
+    scale=0.1,
+    shear=10,
+    perspective=0.0,
+    border=(0, 0),
+):
+    height = shape[0] + border[0] * 2
+    width = shape[1] + border[1] * 2
     C = np.eye(3)
-    C[0, 2] = -img.shape[1] / 2
-    C[1, 2] = -img.shape[0] / 2
-    P = np.eye(3)
-    P[2, 0] = random.uniform(-perspective, perspective)
-    P[2, 1] = random.uniform(-perspective, perspective)
+    C[0, 2] = -shape[1] / 2
+    C[1, 2] = -shape[0] / 2
+    if perspective:
+        P = np.eye(3)
+        P[2, 0] = random.uniform(-perspective, perspective)
+        P[2, 1] = random.uniform(-perspective, perspective)
     R = np.eye(3)
     a = random.uniform(-degrees, degrees)
     s = random.uniform(1 - scale, 1 + scale)
@@ -681,37 +926,58 @@ def random_perspective(
     T = np.eye(3)
     T[0, 2] = random.uniform(0.5 - translate, 0.5 + translate) * width
     T[1, 2] = random.uniform(0.5 - translate, 0.5 + translate) * height
-    M = T @ S @ R @ P @ C
-    if border[0] != 0 or border[1] != 0 or (M != np.eye(3)).astype("bool").any():
-        if perspective:
-            img = cv2.warpPerspective(
-                img, M, dsize=(width, height), borderValue=(114, 114, 114)
-            )
-        else:
-            img = cv2.warpAffine(
-                img, M[:2], dsize=(width, height), borderValue=(114, 114, 114)
-            )
+    if perspective:
+        return T @ S @ R @ P @ C, s
+    return (T @ S @ R @ C)[:2], s
+
+
+def warp_image(img, M, dsize):
+    if len(M) == 3:
+        return cv2.warpPerspective(img, M, dsize=dsize, borderValue=(114, 114, 114))
+    return cv2.warpAffine(img, M, dsize=dsize, borderValue=(114, 114, 114))
+
+
+def warp_source_roi(M, dsize, shape):
+    if len(M) == 3:
+        return 0, 0, shape[1], shape[0]
+    w, h = dsize
+    Mi = cv2.invertAffineTransform(M)
+    xy = np.array([[0, 0], [w - 1, 0], [0, h - 1], [w - 1, h - 1]]) @ Mi[:, :2].T
+    xy += Mi[:, 2]
+    x0, y0 = np.floor(xy.min(0)).astype(int) - 1
+    x1, y1 = np.ceil(xy.max(0)).astype(int) + 2
+    x0, y0 = min(max(x0, 0), shape[1] - 1), min(max(y0, 0), shape[0] - 1)
+    x1, y1 = max(min(x1, shape[1]), x0 + 1), max(min(y1, shape[0]), y0 + 1)
+    return x0, y0, x1, y1
+
+
+def warp_targets(targets, M, s, dsize):
+    width, height = dsize
     n = len(targets)
     if n:
-        xy = np.ones((n * 4, 3))
-        xy[:, :2] = targets[:, [1, 2, 3, 4, 1, 4, 3, 2]].reshape(n * 4, 2)
-        xy = xy @ M.T
-        if perspective:
+        xy = targets[:, [1, 2, 3, 4, 1, 4, 3, 2]].reshape(n * 4, 2)
+        xy = xy @ M[:, :2].T + M[:, 2]
+        if len(M) == 3:
             xy = (xy[:, :2] / xy[:, 2:3]).reshape(n, 8)
         else:
-            xy = xy[:, :2].reshape(n, 8)
-        x = xy[:, [0, 2, 4, 6]]
-        y = xy[:, [1, 3, 5, 7]]
-        xy = np.concatenate((x.min(1), y.min(1), x.max(1), y.max(1))).reshape(4, n).T
-        xy[:, [0, 2]] = xy[:, [0, 2]].clip(0, width)
-        xy[:, [1, 3]] = xy[:, [1, 3]].clip(0, height)
+            xy = xy.reshape(n, 8)
+        x, y = xy[:, 0::2], xy[:, 1::2]
+        xy = np.empty((n, 4), dtype=x.dtype)
+        x.min(1, out=xy[:, 0])
+        y.min(1, out=xy[:, 1])
+        x.max(1, out=xy[:, 2])
+        y.max(1, out=xy[:, 3])
+        np.clip(xy[:, 0::2], 0, width, out=xy[:, 0::2])
+        np.clip(xy[:, 1::2], 0, height, out=xy[:, 1::2])
         i = box_candidates(box1=targets[:, 1:5].T * s, box2=xy.T)
         targets = targets[i]
         targets[:, 1:5] = xy[i]
-    return img, targets
+    return targets
 
 
 def box_candidates(box1, box2, wh_thr=2, ar_thr=20, area_thr=0.2):
+    if numba is not None:
+        return _box_candidates_numba(box1, box2, wh_thr, ar_thr, area_thr)
     w1, h1 = box1[2] - box1[0], box1[3] - box1[1]
     w2, h2 = box2[2] - box2[0], box2[3] - box2[1]
     ar = np.maximum(w2 / (h2 + 1e-16), h2 / (w2 + 1e-16))
@@ -723,6 +989,26 @@ def box_candidates(box1, box2, wh_thr=2, ar_thr=20, area_thr=0.2):
     )
 
 
+def _box_candidates_numba(box1, box2, wh_thr, ar_thr, area_thr):
+    n = box2.shape[1]
+    out = np.empty(n, dtype=np.bool_)
+    for i in range(n):
+        w1, h1 = box1[2, i] - box1[0, i], box1[3, i] - box1[1, i]
+        w2, h2 = box2[2, i] - box2[0, i], box2[3, i] - box2[1, i]
+        ar = max(w2 / (h2 + 1e-16), h2 / (w2 + 1e-16))
+        out[i] = (
+            w2 > wh_thr
+            and h2 > wh_thr
+            and w2 * h2 / (w1 * h1 + 1e-16) > area_thr
+            and ar < ar_thr
+        )
+    return out
+
+
+if numba is not None:
+    _box_candidates_numba = numba.njit(cache=True)(_box_candidates_numba)
+
+
 def cutout(image, labels):
     h, w = image.shape[:2]
 
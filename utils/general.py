@@ -74,9 +74,8 @@ def check_anchors(dataset, model, thr=4.0, imgsz=640):
     shapes = imgsz * dataset.shapes / dataset.shapes.max(1, keepdims=True)
     scale = np.random.uniform(0.9, 1.1, size=(shapes.shape[0], 1))
     wh = paddle.to_tensor(
-        data=np.concatenate(
-            [(l[:, 3:5] * s) for s, l in zip(shapes * scale, dataset.labels)]
-        )
+        data=dataset.labels_flat[:, 3:5]
+        * np.repeat(shapes * scale, np.diff(dataset.label_offsets), 0)
     ).astype(dtype="float32")
 
     def metric(k):
@@ -957,7 +956,9 @@ def kmean_anchors(
     else:
         dataset = path
     shapes = img_size * dataset.shapes / dataset.shapes.max(1, keepdims=True)
-    wh0 = np.concatenate([(l[:, 3:5] * s) for s, l in zip(shapes, dataset.labels)])
+    wh0 = dataset.labels_flat[:, 3:5] * np.repeat(
+        shapes, np.diff(dataset.label_offsets), 0
+    )
     i = (wh0 < 3.0).astype("bool").any(axis=1).sum()
     if i:
         print(